@@ -11,7 +11,7 @@ The result of running this file is the creation of a signac workspace:
 
 import logging
 from collections import OrderedDict
-from itertools import product
+from itertools import chain, product
 
 import signac
 
@@ -43,12 +43,37 @@ def get_parameters():
     parameters["mixing_kT"] = [10]
     parameters["mixing_max_trans"] = [0.5]
 
-    parameters["n_steps"] = [[5e5]]
-    parameters["kT"] = [[1.5]]
-    parameters["max_trans"] = [[0.4]]
     parameters["seed"] = [20]
 
-    return list(parameters.keys()), list(product(*parameters.values()))
+    # run schedules: the i-th entries of each parameter in a fixed group are
+    # used together instead of being crossed with each other
+    schedule = OrderedDict()
+    schedule["n_steps"] = [[5e5]]
+    schedule["kT"] = [[1.5]]
+    schedule["max_trans"] = [[0.4]]
+
+    return parameters, [schedule]
+
+
+def expand_parameters(parameters, fixed_groups=()):
+    """
+    Yields the state points spanned by the free parameters and fixed groups.
+    Free parameters are crossed with everything else, while the parameters of a
+    fixed group vary in lockstep, so each group only adds one axis to the product.
+    :param parameters: Mapping of free parameter names to lists of values.
+    :param fixed_groups: Mappings of parameter names to equal-length lists of values.
+    :return: Generator of state point dictionaries.
+    """
+    param_names = list(parameters.keys())
+    axes = [[(value,) for value in values] for values in parameters.values()]
+    for group in fixed_groups:
+        lengths = {name: len(values) for name, values in group.items()}
+        if len(set(lengths.values())) > 1:
+            raise ValueError(f"parameters in a fixed group must have the same number of values: {lengths}")
+        param_names.extend(group.keys())
+        axes.append(list(zip(*group.values())))
+    for combination in product(*axes):
+        yield dict(zip(param_names, chain.from_iterable(combination)))
 
 
 custom_job_doc = {}  # add keys and values for each job document created
@@ -56,29 +81,39 @@ custom_job_doc = {}  # add keys and values for each job document created
 
 def main(root):
     project = signac.init_project("MCMC-project", root=root)  # Set the signac project name
-    param_names, param_combinations = get_parameters()
-    # Create jobs
-    for params in param_combinations:
-        parent_statepoint = dict(zip(param_names, params))
-        parent_job = project.open_job(parent_statepoint)
-        parent_job.init()
-        parent_job.doc.setdefault("job_type", "sim")
-        parent_job.doc.setdefault("swap", False)
-        parent_job.doc.setdefault("done", False)
-        parent_job.doc.setdefault("current_run", 0)
-        parent_job.doc.setdefault("mixed", False)
-        parent_job.doc.setdefault("timestep", [])
-        parent_job.doc.setdefault("accepted_moves", [])
-        parent_job.doc.setdefault("rejected_moves", [])
-        parent_job.doc.setdefault("acceptance_ratio", [])
-        parent_job.doc.setdefault("tps", [])
-        parent_job.doc.setdefault("energy", [])
-        parent_job.doc.setdefault("avg_PE", [])
-    if custom_job_doc:
-        for key in custom_job_doc:
-            parent_job.doc.setdefault(key, custom_job_doc[key])
-
-    project.write_statepoints()
+    parameters, fixed_groups = get_parameters()
+    job_doc_defaults = {
+        "job_type": "sim",
+        "swap": False,
+        "done": False,
+        "current_run": 0,
+        "mixed": False,
+        "timestep": [],
+        "accepted_moves": [],
+        "rejected_moves": [],
+        "acceptance_ratio": [],
+        "tps": [],
+        "energy": [],
+        "avg_PE": [],
+        # compile the energy function with numba (requires numba), kept out of the
+        # statepoint since it does not change the results
+        "jit_energy_func": False,
+        **custom_job_doc,
+    }
+    statepoints = []
+    # Create jobs. Buffering collects all workspace metadata writes and
+    # flushes them once when the loop is done.
+    with signac.buffered():
+        for parent_statepoint in expand_parameters(parameters, fixed_groups):
+            statepoints.append(parent_statepoint)
+            parent_job = project.open_job(parent_statepoint)
+            parent_job.init()
+            # only fill in missing keys so re-running init keeps existing progress
+            parent_job.doc.update(
+                {key: value for key, value in job_doc_defaults.items() if key not in parent_job.doc}
+            )
+
+    project.write_statepoints(statepoints)
 
 def init_jobs(root='../'):
     logging.basicConfig(level=logging.INFO)
@@ -20,6 +20,7 @@ sys.path.append(parent)
 
 from flow import FlowProject, directives
 from flow.environment import DefaultSlurmEnvironment
+import signac
 from MCMC import Simulation
 from MCMC.utils import inverse_distance_attractive, inverse_distance_repulsive, lj_energy
 
@@ -29,6 +30,21 @@ ENERGY_FUNCS = {"lj": lj_energy,
                 "i_dist_rep": inverse_distance_repulsive}
 
 
+def get_energy_func(name, jit=False):
+    """
+    Looks up an energy function, optionally compiled with numba.
+    Compiled functions are cached on disk, so only the first job pays the compilation cost.
+    :param name: Key of the energy function in ENERGY_FUNCS.
+    :param jit: Compile the function with numba.njit.
+    :return: The energy function.
+    """
+    energy_func = ENERGY_FUNCS[name]
+    if jit:
+        from numba import njit
+        energy_func = njit(cache=True, fastmath=True)(energy_func)
+    return energy_func
+
+
 class MyProject(FlowProject):
     pass
 
@@ -88,6 +104,38 @@ def is_sim(job):
     return job.doc["job_type"] == "sim"
 
 
+def mark_done(job):
+    """
+    Flags a simulation as done and leaves a done_<job id> sentinel file in the project root,
+    so the PT driver can check all replicas without reading every job document.
+    :param job: signac job of the simulation.
+    :return:
+    """
+    job.doc["done"] = True
+    project = signac.get_project(job.ws)
+    open(project.fn(f"done_{job.id}"), "w").close()
+
+
+def record_run(job, sim, **extra):
+    """
+    Appends the results of the last run to the job document, flushing the document once.
+    :param job: signac job of the simulation.
+    :param sim: The Simulation that was run.
+    :param extra: Additional job document lists to append to.
+    :return:
+    """
+    updates = {"timestep": sim.timestep,
+               "accepted_moves": sim.accepted_moves,
+               "rejected_moves": sim.rejected_moves,
+               "acceptance_ratio": sim.acceptance_ratio,
+               "tps": sim.tps,
+               "energy": sim.energy,
+               **extra}
+    with signac.buffered():
+        for key, value in updates.items():
+            job.doc[key].append(value)
+
+
 @directives(executable="python -u")
 @MyProject.operation
 @MyProject.post(sampled)
@@ -104,9 +152,10 @@ def sample(job):
 
         # Setting up the system
         restart = job.isfile("restart.gsd")
+        energy_func = get_energy_func(job.sp.energy_func, jit=job.doc.get("jit_energy_func", False))
         sim = Simulation(n_particles=job.sp.n_particles, n_density=job.sp.n_density, r=job.sp.r, r_cut=job.sp.r_cut,
                          energy_write_freq=job.sp.energy_write_freq, trajectory_write_freq=job.sp.trajectory_write_freq,
-                         energy_func=ENERGY_FUNCS[job.sp.energy_func], hard_sphere=job.sp.hard_sphere, restart=restart,
+                         energy_func=energy_func, hard_sphere=job.sp.hard_sphere, restart=restart,
                          sigma=job.sp.sigma, epsilon=job.sp.epsilon, n=job.sp.n, m=job.sp.m, e_factor=job.sp.e_factor,
                          seed=job.sp.seed)
         job.doc["L"] = sim.L
@@ -121,12 +170,7 @@ def sample(job):
             print("----------------------")
             sim.run(n_steps=job.sp.mixing_steps, kT=job.sp.mixing_kT, max_trans=job.sp.mixing_max_trans)
             sim.save_trajectory(fname="trajectory_mixing.gsd")
-            job.doc["timestep"].append(sim.timestep)
-            job.doc["accepted_moves"].append(sim.accepted_moves)
-            job.doc["rejected_moves"].append(sim.rejected_moves)
-            job.doc["acceptance_ratio"].append(sim.acceptance_ratio)
-            job.doc["tps"].append(sim.tps)
-            job.doc["energy"].append(sim.energy)
+            record_run(job, sim)
             job.doc["mixed"] = True
             sim.reset_system()
 
@@ -141,18 +185,12 @@ def sample(job):
             else:
                 sim.save_trajectory(fname="trajectory_{}.gsd".format(job.doc["current_run"]))
             sim.save_snapshot('restart.gsd')
-            job.doc["timestep"].append(sim.timestep)
-            job.doc["accepted_moves"].append(sim.accepted_moves)
-            job.doc["rejected_moves"].append(sim.rejected_moves)
-            job.doc["acceptance_ratio"].append(sim.acceptance_ratio)
-            job.doc["tps"].append(sim.tps)
-            job.doc["energy"].append(sim.energy)
-            job.doc["avg_PE"].append(np.average(sim.energies))
+            record_run(job, sim, avg_PE=np.mean(sim.energies))
             sim.reset_system()
             job.doc["current_run"] += 1
 
         # TODO: Find a way to check the timestep based on all the run attempts from PT.
-        job.doc["done"] = True
+        mark_done(job)
         print("-----------------------------")
         print("Simulation finished completed")
         print("-----------------------------")
@@ -32,18 +32,19 @@ def get_parameters():
     ]
     parameters["seed"] = [20]
 
+    # run every swap attempt as its own short Slurm job chained behind the simulations,
+    # instead of one long-running driver that polls for them
+    parameters["chain_swaps"] = [True]
     # total number of swaps`
     parameters["n_attempts"] = [20]
-    # initial wait time (including mixing run)
-    parameters["first_wait"] = [1500]
-    # initial wait time (in seconds) before checking the status of jobs
-    parameters["init_wait"] = [1000]
-    # additional wait time (in seconds) after the first wait time is over and jobs are still not done
-    parameters["extra_wait"] = [500]
-    # maximum wait time (in seconds)
+    # wait time (in seconds) after the first status check, doubled after every check
+    parameters["base_wait"] = [60]
+    # maximum wait time (in seconds) between status checks
+    parameters["max_wait"] = [1000]
+    # maximum number of status checks
     parameters["max_tries"] = [200]
 
-    return list(parameters.keys()), list(product(*parameters.values()))
+    return list(parameters.keys()), product(*parameters.values())
 
 
 def main():
@@ -57,7 +58,6 @@ def main():
         parent_job.doc.setdefault("done", False)
         parent_job.doc.setdefault("job_type", "PT")
         parent_job.doc.setdefault("current_attempt", 0)
-        parent_job.doc.setdefault("swap_history", [])
         parent_job.doc.setdefault("accepted_attempts", [])
         parent_job.doc.swap_parameter = parent_job.sp.group_by
 
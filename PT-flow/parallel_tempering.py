@@ -3,7 +3,18 @@ Execute this script directly from the command line, to view your project's
 status, execute operations and submit them to a cluster. See also:
     $ python src/project.py --help
 """
+import asyncio
+import functools
+import getpass
+import glob
+import importlib.util
+import itertools
+import json
+import logging
+import math
 import os
+import shutil
+import subprocess
 import sys
 import time
 
@@ -23,8 +34,9 @@ from flow import FlowProject, directives
 from flow.environment import DefaultSlurmEnvironment
 import signac
 import random
-import copy
-import gsd.hoomd
+
+
+logger = logging.getLogger(__name__)
 
 
 class PT_Project(FlowProject):
@@ -81,33 +93,38 @@ def initialized(job):
     return job.doc.get("current_attempt") > 0
 
 
-def wait(init_wait, extra_wait, max_tries):
+# seconds a squeue result is reused for, so concurrent status checks share one scheduler query
+SQUEUE_CACHE_TIME = 30
+# last squeue result for a set of job ids, stored with the time of the query
+_squeue_cache = {}
+# neighbor pairs accepting fewer swaps than this are reported as too far apart on the ladder,
+# once they have been tested at least MIN_PAIR_ATTEMPTS times
+MIN_ACCEPTANCE = 0.05
+MIN_PAIR_ATTEMPTS = 10
+
+
+def wait(base_wait, max_wait, max_tries):
     """
-    Waits for a certain amount of time for the simulations to finish.
-    :param init_wait: Initial wait time before first status check.
-    :param extra_wait: Wait time between status checks.
+    Waits for the simulations to finish, backing off exponentially between status checks.
+    The wrapped check becomes a coroutine that runs in a worker thread, so a single event loop
+    can wait on several PT runs at once.
+    :param base_wait: Wait time after the first unsuccessful status check.
+    :param max_wait: Maximum wait time between status checks.
     :param max_tries: Maximum number of status checks.
     :return:
     """
 
     def decorator(function):
-        def wrapper(*args, **kwargs):
+        async def wrapper(*args, **kwargs):
             retries = 0
-            start_init = time.time()
-            print('initial sleep.....')
-            time.sleep(init_wait)
-            print('init wait time: ', time.time() - start_init)
             while retries < max_tries:
-                print('try: ', retries)
-                value = function(*args, **kwargs)
+                value = await asyncio.to_thread(function, *args, **kwargs)
                 if value:
                     return value
-                else:
-                    start_add = time.time()
-                    print('additional sleep.....')
-                    time.sleep(extra_wait)
-                    print('additional wait: ', time.time() - start_add)
-                    retries += 1
+                sleep_time = min(max_wait, base_wait * 2 ** retries)
+                logger.debug("simulations not finished after %d checks, waiting %d s", retries + 1, sleep_time)
+                await asyncio.sleep(sleep_time)
+                retries += 1
             return False
 
         return wrapper
@@ -115,161 +132,486 @@ def wait(init_wait, extra_wait, max_tries):
     return decorator
 
 
+@functools.lru_cache(maxsize=4)
+def _cached_project(root):
+    return signac.get_project(root)
+
+
+def get_sim_project():
+    """
+    Finds the simulation project from the current working directory, reusing earlier lookups.
+    Only call this after the simulation project has been initialized.
+    :return: The simulation signac project.
+    """
+    return _cached_project(os.getcwd())
+
+
 def get_sim_jobs():
-    project = signac.get_project()
+    project = get_sim_project()
     jobs_list = project.find_jobs({'doc.job_type': "sim"})
     return jobs_list
 
 
-def check_status(init_wait, extra_wait, max_tries):
-    @wait(init_wait, extra_wait, max_tries)
+def queued_slurm_jobs():
+    """
+    Lists the current user's jobs in the Slurm queue.
+    :return: Dictionary of Slurm job id to job name, empty if Slurm is not available.
+    """
+    if shutil.which("squeue") is None:
+        return {}
+    result = subprocess.run(
+        ["squeue", "-h", "-u", getpass.getuser(), "-o", "%i %j"], capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"squeue failed: {result.stderr.strip()}")
+    return dict(line.split(" ", 1) for line in result.stdout.splitlines() if line.strip())
+
+
+def pending_step(job):
+    """
+    Finds the chained PT step submitted last if it is still queued and is not the running Slurm job.
+    :param job: signac job of the PT run.
+    :return: Slurm job id of the pending step, None if there is none.
+    """
+    step_id = job.doc.get("next_step_id")
+    if step_id is None or step_id == os.environ.get("SLURM_JOB_ID"):
+        return None
+    return step_id if step_id in queued_slurm_jobs() else None
+
+
+@PT_Project.label
+def step_queued(job):
+    return pending_step(job) is not None
+
+
+def get_slurm_ids(project, queued_before):
+    """
+    Finds the Slurm job ids of the cluster jobs a project submission just created.
+    Flow names its cluster jobs after the project, so jobs that were already queued and
+    jobs of other projects, like the PT driver itself, are left out.
+    :param project: The simulation FlowProject that submitted the jobs.
+    :param queued_before: Slurm job ids that were queued before the submission.
+    :return: List of Slurm job ids, empty if Slurm is not available.
+    """
+    if shutil.which("squeue") is None:
+        return []
+    slurm_ids = [slurm_id for slurm_id, name in queued_slurm_jobs().items()
+                 if slurm_id not in queued_before and str(project) in name]
+    if not slurm_ids:
+        raise RuntimeError(f"no new Slurm jobs of project {project} found after submitting")
+    return slurm_ids
+
+
+def slurm_jobs_finished(slurm_ids):
+    """
+    Checks with a single squeue call whether all the given Slurm jobs have left the queue.
+    :param slurm_ids: List of Slurm job ids returned by submit_sims, each seen in the queue after submitting.
+    :return: True if none of the jobs is pending or running anymore.
+    """
+    invalid = [slurm_id for slurm_id in slurm_ids if not str(slurm_id).isdigit()]
+    if invalid:
+        raise ValueError(f"{invalid} are not Slurm job ids")
+    key = tuple(slurm_ids)
+    cached = _squeue_cache.get(key)
+    if cached is not None and time.time() - cached[0] < SQUEUE_CACHE_TIME:
+        return cached[1]
+    result = subprocess.run(
+        ["squeue", "-h", "-o", "%i", "--jobs", ",".join(map(str, slurm_ids))], capture_output=True, text=True
+    )
+    if result.returncode == 0:
+        finished = not result.stdout.strip()
+    elif "Invalid job id" in result.stderr:
+        # the ids were in the queue when they were submitted, so the controller
+        # has purged them after they ended long enough ago
+        finished = True
+    else:
+        raise RuntimeError(f"squeue failed: {result.stderr.strip()}")
+    _squeue_cache[key] = (time.time(), finished)
+    return finished
+
+
+def count_done_sims():
+    """
+    Counts the done_<job id> sentinel files the simulations leave in their project root.
+    :return: Number of finished simulations.
+    """
+    return len(glob.glob(get_sim_project().fn("done_*")))
+
+
+async def check_status_async(slurm_ids, n_sims, base_wait, max_wait, max_tries):
+    @wait(base_wait, max_wait, max_tries)
     def _check_status():
-        return all([job.doc["done"] for job in get_sim_jobs()])
+        if slurm_ids and not slurm_jobs_finished(slurm_ids):
+            return False
+        if count_done_sims() == n_sims:
+            return True
+        if slurm_ids:
+            raise RuntimeError(f"simulation jobs {slurm_ids} ended before all simulations were done")
+        return False
 
-    return _check_status()
+    return await _check_status()
 
 
-def update_swap_info(swap):
-    swap["done"] = True
-    project = signac.get_project()
-    job_i = project.open_job(id=swap["job_i"])
-    job_j = project.open_job(id=swap["job_j"])
-    # job i and j from previous swap no longer need the swap flag to be True.
-    job_i.doc["swap"] = False
-    job_j.doc["swap"] = False
+def check_status(slurm_ids, n_sims, base_wait, max_wait, max_tries):
+    return asyncio.run(check_status_async(slurm_ids, n_sims, base_wait, max_wait, max_tries))
+
+
+def append_swap_history(job, swap):
+    """
+    Appends a swap record to the PT job's swap_history.jsonl, one JSON object per line.
+    :param job: signac job of the PT run.
+    :param swap: Dictionary describing the swap.
+    :return:
+    """
+    with open(job.fn("swap_history.jsonl"), "a") as f:
+        f.write(json.dumps(swap) + "\n")
+
+
+def read_swap_history(job):
+    """
+    Reads all swap records of a PT job.
+    :param job: signac job of the PT run.
+    :return: List of swap dictionaries, oldest first.
+    """
+    if not job.isfile("swap_history.jsonl"):
+        return []
+    with open(job.fn("swap_history.jsonl")) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def last_accepted_swaps(job):
+    """
+    Finds the accepted swaps of the most recent attempt that exchanged configurations.
+    :param job: signac job of the PT run.
+    :return: List of swap dictionaries, empty before the first accepted swap.
+    """
+    if not job.doc["accepted_attempts"]:
+        return []
+    attempt = job.doc["accepted_attempts"][-1]
+    return [swap for swap in read_swap_history(job) if swap["attempt"] == attempt and swap["accepted"]]
+
+
+def update_swap_info(jobs_by_id, swaps):
+    for swap in swaps:
+        job_i = jobs_by_id[swap["job_i"]]
+        job_j = jobs_by_id[swap["job_j"]]
+        # job i and j from previous swap no longer need the swap flag to be True.
+        job_i.doc["swap"] = False
+        job_j.doc["swap"] = False
+
+
+def final_kT(job):
+    """
+    Finds the temperature a simulation job ran at last.
+    :param job: signac job of the simulation.
+    :return: kT of the job, or the last kT of its schedule.
+    """
+    try:
+        return job.sp.kT[-1]
+    except TypeError:
+        return job.sp.kT
+
+
+def swap_probability(job_i, job_j, energy_i, energy_j, swap_parameter):
+    """
+    Computes the Metropolis acceptance probability for exchanging the configurations of two replicas.
+    :param job_i: signac job of the first simulation.
+    :param job_j: signac job of the second simulation.
+    :param energy_i: Potential energy of the first simulation's configuration.
+    :param energy_j: Potential energy of the second simulation's configuration.
+    :param swap_parameter: State point parameter the replicas differ in, kT or e_factor.
+    :return: Probability between 0 and 1.
+    """
+    if swap_parameter == "kT":
+        delta = (1 / final_kT(job_i) - 1 / final_kT(job_j)) * (energy_i - energy_j)
+    elif swap_parameter == "e_factor":
+        # same temperature, the recorded energies are scaled by each replica's e_factor
+        e_factor_i = job_i.sp.e_factor
+        e_factor_j = job_j.sp.e_factor
+        delta = (e_factor_i - e_factor_j) * (energy_i / e_factor_i - energy_j / e_factor_j) / final_kT(job_i)
+    else:
+        raise ValueError(f"no acceptance criterion for swapping {swap_parameter}")
+    return 1.0 if delta >= 0 else math.exp(delta)
+
+
+def read_particle_count(job):
+    """
+    Reads the number of particles in a simulation job's restart.gsd.
+    Only the particles/N chunk is read, the rest of the frame is never decoded.
+    :param job: signac job of the simulation.
+    :return: Number of particles in the first frame.
+    """
+    import gsd.fl
+
+    with gsd.fl.open(name=job.fn("restart.gsd"), mode="rb") as f:
+        return int(f.read_chunk(frame=0, name="particles/N")[0])
+
+
+def swap_restarts(job_i, job_j):
+    """
+    Exchanges the configurations of two simulation jobs by swapping their restart.gsd files.
+    Renaming only touches directory entries, so no particle data is rewritten. The velocities
+    are exchanged as well and have to be rescaled to the new temperatures by the caller.
+    :param job_i: signac job of the first simulation.
+    :param job_j: signac job of the second simulation.
+    :return:
+    """
+    n_i = read_particle_count(job_i)
+    n_j = read_particle_count(job_j)
+    if n_i != n_j:
+        raise RuntimeError(f"can not swap configurations with different number of particles: {n_i} and {n_j}")
+    fname_i = job_i.fn("restart.gsd")
+    fname_j = job_j.fn("restart.gsd")
+    tmp_fname = fname_i + ".swap"
+    os.replace(fname_i, tmp_fname)
+    os.replace(fname_j, fname_i)
+    os.replace(tmp_fname, fname_j)
+
+
+# init and project modules of each simulation mode, loaded once per process
+_mode_modules = {}
+
+
+def load_mode(mode):
+    """
+    Imports the init and project modules of a simulation mode, reusing them on later calls.
+    :param mode: Name of the simulation flow directory, e.g. polymer-flow.
+    :return: Tuple of the init and project modules.
+    """
+    if mode not in _mode_modules:
+        path = os.path.join(parent, mode)
+        modules = []
+        for name in ("init", "project"):
+            spec = importlib.util.spec_from_file_location(f"{mode}.{name}", os.path.join(path, f"{name}.py"))
+            module = importlib.util.module_from_spec(spec)
+            # registered so flow can resolve the module of the project class when submitting
+            sys.modules[spec.name] = module
+            spec.loader.exec_module(module)
+            modules.append(module)
+        _mode_modules[mode] = tuple(modules)
+    return _mode_modules[mode]
 
 
 def submit_sims(project):
-    for job in get_sim_jobs():
-        job.doc["done"] = False
+    """
+    Marks all simulation jobs as not done and submits them.
+    :param project: The simulation FlowProject.
+    :return: List of Slurm job ids of the submitted simulations.
+    """
+    jobs = list(get_sim_jobs())
+    with signac.buffered():
+        for job in jobs:
+            job.doc["done"] = False
+            sentinel = project.fn(f"done_{job.id}")
+            if os.path.exists(sentinel):
+                os.remove(sentinel)
+    # a bundle requests the summed GPUs on one node and leaves every replica on the same device,
+    # so operations that need a GPU are submitted as one cluster job per replica
+    directives = project.groups["sample"].operation_directives.get("sample", {})
+    bundle_size = 1 if directives.get("ngpu", 0) else len(jobs)
+    queued_before = set(queued_slurm_jobs())
     try:
-        project.submit()
-        print("----------------------")
-        print("Successfully submitted simulations...")
-        print("----------------------")
+        # only the replicas' sample operations are evaluated for eligibility
+        project.submit(jobs=jobs, names=["sample"], bundle_size=bundle_size, parallel=bundle_size > 1)
+        logger.info("Successfully submitted simulations")
     except Exception as error:
         raise RuntimeError(f"project submission failed. Error at line: {error.args[0]}")
+    return get_slurm_ids(project, queued_before)
 
 
 def submit_post(project):
-    for job in get_sim_jobs():
-        job.doc["pt_done"] = True
-        job.doc["averaged"] = False
+    with signac.buffered():
+        for job in get_sim_jobs():
+            job.doc.update({"pt_done": True, "averaged": False})
     try:
         project.submit()
-        print("----------------------")
-        print("Successfully submitted simulations...")
-        print("----------------------")
+        logger.info("Successfully submitted simulations")
     except Exception as error:
         raise RuntimeError(f"project submission failed. Error at line: {error.args[0]}")
 
 
+def attempt_swaps(job, sim_jobs):
+    """
+    Attempts to swap the configurations of every disjoint pair of neighboring replicas with the
+    Metropolis criterion. Even attempts sweep the pairs (0, 1), (2, 3), ..., odd attempts the
+    pairs (1, 2), (3, 4), ..., so every neighbor pair is tried once every two attempts.
+    :param job: signac job of the PT run.
+    :param sim_jobs: List of (swap parameter, simulation job) pairs sorted by the swap parameter.
+    :return:
+    """
+    attempt = job.doc["current_attempt"]
+    # per neighbor pair counts, indexed by the lower replica j of the pair
+    attempt_counts = list(job.doc.get("attempt_counts", [0] * (len(sim_jobs) - 1)))
+    accept_counts = list(job.doc.get("accept_counts", [0] * (len(sim_jobs) - 1)))
+    swapped = []
+    # the pairs are disjoint, so every test only uses the energies the replicas finished with
+    for j in range(attempt % 2, len(sim_jobs) - 1, 2):
+        # j is the neighbor with lower e_factor (equivalent to higher T)
+        i = j + 1
+        param_i, job_i = sim_jobs[i]
+        param_j, job_j = sim_jobs[j]
+        energy_i = job_i.doc["energy"][-1]
+        energy_j = job_j.doc["energy"][-1]
+        probability = swap_probability(job_i, job_j, energy_i, energy_j, job.sp.group_by)
+        accepted = random.random() < probability
+        logger.debug("swapping %s %s with %s (probability %.3f): %s", job.doc.swap_parameter, param_i, param_j,
+                     probability, "accepted" if accepted else "rejected")
+        append_swap_history(job, {"attempt": attempt, "i": i, "j": j,
+                                  "param_i": param_i, "param_j": param_j,
+                                  "job_i": job_i.id, "job_j": job_j.id,
+                                  "energy_i": energy_i, "energy_j": energy_j,
+                                  "probability": probability, "accepted": accepted})
+        attempt_counts[j] += 1
+        if accepted:
+            accept_counts[j] += 1
+            # swap configurations
+            swap_restarts(job_i, job_j)
+            # the restart velocities come from the other temperature, the simulations
+            # scale them by this factor before running again
+            velocity_scale = math.sqrt(final_kT(job_i) / final_kT(job_j))
+            job_i.doc.update({"swap": True, "velocity_scale": velocity_scale})
+            job_j.doc.update({"swap": True, "velocity_scale": 1 / velocity_scale})
+            swapped.extend([job_i, job_j])
+    # all changes of this attempt go into one write of the PT job document
+    doc_update = {"current_attempt": attempt + 1,
+                  "attempt_counts": attempt_counts,
+                  "accept_counts": accept_counts}
+    if swapped:
+        doc_update["accepted_attempts"] = list(job.doc["accepted_attempts"]) + [attempt]
+    job.doc.update(doc_update)
+    for j in range(attempt % 2, len(sim_jobs) - 1, 2):
+        acceptance = accept_counts[j] / attempt_counts[j]
+        if attempt_counts[j] >= MIN_PAIR_ATTEMPTS and acceptance < MIN_ACCEPTANCE:
+            logger.warning("only %.1f%% of the swaps between %s %s and %s were accepted, "
+                           "consider adding a replica in between", 100 * acceptance,
+                           job.doc.swap_parameter, sim_jobs[j][0], sim_jobs[j + 1][0])
+    logger.info("attempt %d: accepted %d of %d swaps", attempt, len(swapped) // 2,
+                len(range(attempt % 2, len(sim_jobs) - 1, 2)))
+
+
+def submit_next_step(job, slurm_ids):
+    """
+    Submits the next run of the PT sample operation as a Slurm job that starts once the replica
+    simulations have left the queue, so no driver has to wait for them.
+    :param job: signac job of the PT run.
+    :param slurm_ids: Slurm job ids of the replica simulations.
+    :return: Slurm job id of the next step.
+    """
+    if not slurm_ids:
+        raise RuntimeError("chaining swaps needs the Slurm job ids of the simulations")
+    invalid = [slurm_id for slurm_id in slurm_ids if not str(slurm_id).isdigit()]
+    if invalid:
+        raise ValueError(f"{invalid} are not Slurm job ids, the next PT step can not depend on them")
+    command = f"{sys.executable} -u {os.path.realpath(__file__)} exec sample {job.id}"
+    sbatch = ["sbatch", "--parsable", "--job-name", f"PT-{job.id}", "--chdir", current,
+              "--dependency", "afterany:" + ":".join(map(str, slurm_ids))]
+    # stay on the partition of the current step when running inside a Slurm job
+    partition = os.environ.get("SLURM_JOB_PARTITION")
+    if partition:
+        sbatch.extend(["--partition", partition])
+    sbatch.extend(["--wrap", command])
+    try:
+        result = subprocess.run(sbatch, capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError as error:
+        raise RuntimeError(f"submitting the next PT step failed. {error.stderr.strip()}")
+    # --parsable prints "<job id>" or "<job id>;<cluster>"
+    step_id = result.stdout.strip().split(";")[0]
+    if not step_id.isdigit():
+        raise RuntimeError(f"sbatch did not return a job id for the next PT step: {result.stdout.strip()}")
+    job.doc["next_step_id"] = step_id
+    logger.info("Submitted the next PT step as Slurm job %s", step_id)
+    return step_id
+
+
 @directives(executable="python -u")
 @directives(ngpu=0)
 @PT_Project.operation
+@PT_Project.pre.not_(step_queued)
 @PT_Project.post(finished)
 def sample(job):
     with job:
-        print("-----------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("-----------------------")
+        logger.info("JOB ID NUMBER: %s", job.id)
         # import files from signac flow
-        project = signac.get_project()
-        path = os.path.join(project.root_directory(), "../{}/".format(job.sp.mode))
-        sys.path.append(path)
-        from init import init_jobs
-        from project import MyProject
-
-        first_wait = job.sp.first_wait
-        init_wait = job.sp.init_wait
-        extra_wait = job.sp.extra_wait
+        init, sim_project = load_mode(job.sp.mode)
+        init_jobs = init.init_jobs
+        MyProject = sim_project.MyProject
+
+        base_wait = job.sp.base_wait
+        max_wait = job.sp.max_wait
         max_tries = job.sp.max_tries
         # Before first swap attempt, first we need to initiate signac project and submit jobs.
-        if job.doc["current_attempt"] == 0:
-            print("----------------------")
-            print("Starting Parallel tempering (First run)...")
-            print("----------------------")
-            print("----------------------")
-            print("Initiating {} project...".format(job.sp.mode))
-            print("----------------------")
+        first_run = "sim_index" not in job.doc
+        if first_run:
+            logger.info("Starting Parallel tempering (First run)")
+            logger.info("Initiating %s project", job.sp.mode)
 
             try:
                 init_jobs()
-                print("----------------------")
-                print("Successfully initiated {} project...".format(job.sp.mode))
-                print("----------------------")
+                logger.info("Successfully initiated %s project", job.sp.mode)
             except Exception as error:
                 raise RuntimeError("project init failed. {}".format(error.args[0]))
 
-            submit_sims(MyProject())
+        flow_project = MyProject()
+        if first_run:
+            job.doc["slurm_ids"] = submit_sims(flow_project)
+
+        # load simulation jobs once, as (swap parameter, job) pairs sorted by the swap parameter
+        project = get_sim_project()
+        if first_run:
+            # index the replicas once, later runs of this operation open the jobs by id
+            def swap_parameter(s_job):
+                return s_job.sp[job.sp.group_by]
+
+            all_sim_jobs = sorted(get_sim_jobs(), key=swap_parameter)
+            job.doc["n_sims"] = len(all_sim_jobs)
+            sim_index = []
+            for v, s_jobs in itertools.groupby(all_sim_jobs, key=swap_parameter):
+                s_jobs = list(s_jobs)
+                if len(s_jobs) > 1:
+                    raise RuntimeError(f"found {len(s_jobs)} simulations with {job.sp.group_by} {v}, "
+                                       f"each replica needs a unique {job.sp.group_by}")
+                sim_index.append([v, s_jobs[0].id])
+            job.doc["sim_index"] = sim_index
+        n_sims = job.doc["n_sims"]
+        sim_jobs = [(v, project.open_job(id=sim_id)) for v, sim_id in job.doc["sim_index"]]
+        jobs_by_id = {s_job.id: s_job for _, s_job in sim_jobs}
+        logger.debug("sim_jobs: %s", sim_jobs)
+
+        if job.sp.get("chain_swaps", False):
+            # Each run of this operation is a single PT step that exits after submitting
+            # the next step behind the replica simulations.
+            step_id = pending_step(job)
+            if step_id is not None:
+                # a second chain would attempt swaps on the same replicas
+                raise RuntimeError(f"PT step {step_id} is still queued, not running another one next to it")
+            if first_run:
+                submit_next_step(job, job.doc["slurm_ids"])
+                return
+            if count_done_sims() != n_sims:
+                raise RuntimeError(f"simulation jobs {list(job.doc['slurm_ids'])} ended before all simulations were done")
+            # every replica has run again since the last attempt, so its swaps are no longer pending
+            update_swap_info(jobs_by_id, last_accepted_swaps(job))
+            if job.doc["current_attempt"] <= job.sp.n_attempts:
+                attempt_swaps(job, sim_jobs)
+                # A rejected swap means the replicas stay where they are, so every replica
+                # runs another interval before the next attempt, accepted or not.
+                job.doc["slurm_ids"] = submit_sims(flow_project)
+                submit_next_step(job, job.doc["slurm_ids"])
+                return
+            job.doc["done"] = True
+            return
 
-        # load simulation jobs and e_factors
-        project = signac.get_project()
-        swap_parameters = []
-        sim_jobs = []
-        for v, s_job in project.find_jobs({"doc.job_type": "sim"}).groupby(job.sp.group_by):
-            swap_parameters.append(v)
-            sim_jobs.append(list(s_job)[0])
-        print('sim_jobs: ', sim_jobs)
         while job.doc["current_attempt"] <= job.sp.n_attempts:
-            print('current swap: ', job.doc["current_attempt"])
             # First, making sure the simulations are finished
-            print("checking status of simulations...")
-            if job.doc["current_attempt"] == 0:
-                # set wait time to be longer for the very first run that includes the mixing phase
-                wait_time = first_wait
-            else:
-                wait_time = init_wait
-            if check_status(wait_time, extra_wait, max_tries):
-                if job.doc["current_attempt"] > 0:
-                    # find the last swap
-                    last_swap = job.doc["swap_history"][-1]
-                    # update last swap information
-                    update_swap_info(last_swap)
-
-                # attempting a swap
-                print("----------------------")
-                print("Initiating a swap...")
-                print("----------------------")
-                # find a random job and a neighbor to swap their configurations
-                i = random.randint(1, len(sim_jobs) - 1)
-                # find the neighbor with lower e_factor (equivalent to higher T)
-                j = i - 1
-                param_i = swap_parameters[i]
-                job_i = sim_jobs[i]
-
-                param_j = swap_parameters[j]
-                job_j = sim_jobs[j]
-                # TODO: get potential energy for both and calculate acceptance criteria.
-                print("----------------------")
-                print(f"Swapping {job.doc.swap_parameter} {param_i} with {param_j}...")
-                print("----------------------")
-                # Accepting the swap
-                job.doc["swap_history"].append({"i": i, "j": j, "param_i": param_i, "param_j": param_j,
-                                                "job_i": job_i.id, "job_j": job_j.id, "done": False})
-                job.doc["current_attempt"] += 1
-
-                snapshot_i = gsd.hoomd.open(job_i.fn("restart.gsd"))[0]
-                positions_i = copy.deepcopy(snapshot_i.particles.position)
-                image_i = copy.deepcopy(snapshot_i.particles.image)
-
-                snapshot_j = gsd.hoomd.open(job_j.fn("restart.gsd"))[0]
-                positions_j = copy.deepcopy(snapshot_j.particles.position)
-                image_j = copy.deepcopy(snapshot_j.particles.image)
-
-                # swap positions and save snapshot TODO: do we need to swap anything else for MD?
-                with gsd.hoomd.open(job_i.fn("restart.gsd"), "wb") as traj:
-                    snapshot_i.particles.position = positions_j
-                    snapshot_i.particles.image = image_j
-                    traj.append(snapshot_i)
-                with gsd.hoomd.open(job_j.fn("restart.gsd"), "wb") as traj:
-                    snapshot_j.particles.position = positions_i
-                    snapshot_j.particles.image = image_i
-                    traj.append(snapshot_j)
-
-                # submit simulations
-                submit_sims(MyProject())
+            logger.debug("checking status of simulations for swap %d", job.doc["current_attempt"])
+            if check_status(job.doc.get("slurm_ids", []), n_sims, base_wait, max_wait, max_tries):
+                # update the information of the last accepted swaps
+                update_swap_info(jobs_by_id, last_accepted_swaps(job))
+
+                attempt_swaps(job, sim_jobs)
+                # A rejected swap means the replicas stay where they are, so every replica
+                # runs another interval before the next attempt, accepted or not.
+                job.doc["slurm_ids"] = submit_sims(flow_project)
 
         job.doc["done"] = True
 
@@ -280,20 +622,13 @@ def sample(job):
 @PT_Project.pre(finished)
 def averaging(job):
     with job:
-        print("-----------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("-----------------------")
+        logger.info("JOB ID NUMBER: %s", job.id)
         # import files from signac flow
-        project = signac.get_project()
-        #path = os.path.join(project.root_directory(), "../{}/".format(job.sp.mode))
-        path = "/home/erjank_project/chrisjones/pt-polymers/parallel-tempering/polymer-flow"
-        sys.path.append(path)
-        #from init import init_jobs
-        from project import MyProject
+        _, sim_project = load_mode(job.sp.mode)
 
-        submit_post(MyProject())
+        submit_post(sim_project.MyProject())
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     PT_Project().main()
@@ -61,32 +61,41 @@ def get_parameters():
     parameters["num_gsd_frames"] = [400]
     parameters["num_data_logs"] = [50000]
 
-    return list(parameters.keys()), list(product(*parameters.values()))
+    return list(parameters.keys()), product(*parameters.values())
 
 
 
 def main(root):
     project = signac.init_project("poly-flow", root=root)
     param_names, param_combinations = get_parameters()
-    # Create jobs
-    for params in param_combinations:
-        parent_statepoint = dict(zip(param_names, params))
-        parent_job = project.open_job(parent_statepoint)
-        parent_job.init()
-        parent_job.doc.setdefault("job_type", "sim")
-        parent_job.doc.setdefault("swap", False)
-        parent_job.doc.setdefault("done", False)
-        parent_job.doc.setdefault("current_run", 0)
-        parent_job.doc.setdefault("ran_shrink", False)
-        parent_job.doc.setdefault("timestep", [])
-        parent_job.doc.setdefault("tps", [])
-        parent_job.doc.setdefault("energy", [])
-        parent_job.doc.setdefault("avg_PE", [])
-        parent_job.doc.total_steps = int(
-                parent_job.sp.n_steps + parent_job.sp.shrink_steps
-        )
-
-    project.write_statepoints()
+    job_doc_defaults = {
+        "job_type": "sim",
+        "swap": False,
+        "velocity_scale": 1.0,
+        "done": False,
+        "current_run": 0,
+        "ran_shrink": False,
+        "timestep": [],
+        "tps": [],
+        "energy": [],
+        "avg_PE": [],
+    }
+    statepoints = []
+    # Create jobs. Buffering collects all workspace metadata writes and
+    # flushes them once when the loop is done.
+    with signac.buffered():
+        for params in param_combinations:
+            parent_statepoint = dict(zip(param_names, params))
+            statepoints.append(parent_statepoint)
+            parent_job = project.open_job(parent_statepoint)
+            parent_job.init()
+            job_doc = {key: value for key, value in job_doc_defaults.items() if key not in parent_job.doc}
+            job_doc["total_steps"] = int(
+                    parent_job.sp.n_steps + parent_job.sp.shrink_steps
+            )
+            parent_job.doc.update(job_doc)
+
+    project.write_statepoints(statepoints)
 
 def init_jobs(root='../'):
     logging.basicConfig(level=logging.INFO)
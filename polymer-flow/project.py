@@ -3,8 +3,10 @@ Execute this script directly from the command line, to view your project's
 status, execute operations and submit them to a cluster. See also:
     $ python src/project.py --help
 """
+import functools
+import importlib
+import mmap
 import os
-import shutil
 import sys
 import pickle
 import numpy as np
@@ -22,12 +24,16 @@ sys.path.append(parent)
 
 from flow import FlowProject, directives
 from flow.environment import DefaultSlurmEnvironment
-import gsd.hoomd
-import hoomd_polymers
-import hoomd_polymers.molecules
-import hoomd_polymers.systems
-import hoomd_polymers.forcefields
-from hoomd_polymers.sim import Simulation
+import signac
+
+
+# column of the potential energy in the sim_data.txt logs
+PE_COLUMN = "md.compute.ThermodynamicQuantities.potential_energy"
+# indices of the particles of a chain its end to end vector points between
+RE_HEAD = 4
+RE_TAIL = 102
+# number of logged potential energies at the end of a run averaged into avg_PE
+N_AVG_PE = 100
 
 
 class MyProject(FlowProject):
@@ -84,7 +90,7 @@ def averaged(job):
 
 @MyProject.label
 def initialized(job):
-    return job.isfile("trajectory.gsd")
+    return job.isfile("restart.gsd")
 
 
 @MyProject.label
@@ -99,17 +105,43 @@ def pt_done(job):
 # Useful functions
 def load_pickle_ff(job, ff_file):
     """Load list of hoomd forces from pickle files in a job's workspace."""
-    with open(job.fn(ff_file), "rb") as f:
-        hoomd_ff = pickle.load(f)
+    # unpickle straight from the mapped file instead of through buffered reads
+    with open(job.fn(ff_file), "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        hoomd_ff = pickle.loads(mm)
     return hoomd_ff
 
 
+@functools.lru_cache(maxsize=None)
+def resolve_hoomd_polymers(submodule, name):
+    """Look up a class of a hoomd_polymers submodule, importing the submodule on first use."""
+    return getattr(importlib.import_module(f"hoomd_polymers.{submodule}"), name)
+
+
+def read_log_column(log_file, column=PE_COLUMN):
+    """Read a single column of a sim_data.txt log, skipping the parsing of all other columns."""
+    with open(log_file) as f:
+        names = f.readline().split()
+        return np.loadtxt(f, usecols=names.index(column), ndmin=1)
+
+
+def mark_done(job):
+    """Flag a job as done and leave a done_<job id> sentinel file for the PT driver."""
+    job.doc["done"] = True
+    project = signac.get_project(job.ws)
+    open(project.fn(f"done_{job.id}"), "w").close()
+
+
 @directives(executable="python -u")
 @directives(ngpu=1)
 @MyProject.operation
 @MyProject.post(sampled)
 @MyProject.pre(is_sim)
 def sample(job):
+    # imported here so the flow CLI does not load hoomd for status and submit calls
+    import gsd.hoomd
+    import hoomd
+    from hoomd_polymers.sim import Simulation
+
     with job:
         print("-----------------------")
         print("JOB ID NUMBER:")
@@ -123,11 +155,13 @@ def sample(job):
         if job.isfile("restart.gsd"): # Initializing from a restart.gsd
             with gsd.hoomd.open(job.fn("restart.gsd")) as traj:
                 init_snap = traj[0]
+            if job.doc["swap"]: # velocities of a swapped configuration belong to the partner's kT
+                init_snap.particles.velocity *= job.doc.get("velocity_scale", 1.0)
             hoomd_ff = load_pickle_ff(job, "forcefield.pickle")
         else: # No restart, generate the system and apply a FF
-            molecule_obj = getattr(hoomd_polymers.molecules, job.sp.molecule)
-            ff_obj = getattr(hoomd_polymers.forcefields, job.sp.forcefield)
-            system_obj = getattr(hoomd_polymers.systems, job.sp.system)
+            molecule_obj = resolve_hoomd_polymers("molecules", job.sp.molecule)
+            ff_obj = resolve_hoomd_polymers("forcefields", job.sp.forcefield)
+            system_obj = resolve_hoomd_polymers("systems", job.sp.system)
             mol_kwargs = {"length": job.sp.polymer_lengths}
             system = system_obj(
                     molecule=molecule_obj,
@@ -149,11 +183,12 @@ def sample(job):
             init_snap = system.hoomd_snapshot
             hoomd_ff = system.hoomd_forcefield
 
-            job.doc.gsd_write_frequency = int(
-                    job.doc.total_steps / job.sp.num_gsd_frames
+            # at least one step apart, more frames than steps would round the period to 0
+            job.doc.gsd_write_frequency = max(
+                    1, int(job.doc.total_steps // job.sp.num_gsd_frames)
             )
-            job.doc.log_write_frequency = int(
-                    job.doc.total_steps / job.sp.num_data_logs
+            job.doc.log_write_frequency = max(
+                    1, int(job.doc.total_steps // job.sp.num_data_logs)
             )
 
         # Set up stuff to initialize a Simulation
@@ -184,45 +219,186 @@ def sample(job):
                     kT=job.sp.shrink_kT,
                     tau_kt=job.sp.tau_kt
             )
-            assert np.array_equal(
-                    sim.box_lengths_reduced, job.doc.target_box_reduced
+            # the box is resized in floating point steps, exact equality is too strict
+            assert np.allclose(
+                    sim.box_lengths_reduced, job.doc.target_box_reduced, rtol=1e-6
             )
             job.doc.ran_shrink = True
             print("----------------------")
             print("Shrink simulation finished...")
             print("----------------------")
 
+        # the log period does not have to divide n_steps, so the energy of the
+        # state saved in restart.gsd is taken from a compute, not the log
+        thermo = hoomd.md.compute.ThermodynamicQuantities(filter=hoomd.filter.All())
+        sim.operations.computes.append(thermo)
         # Run NVT simulation. # Starting here for jobs after swaps
         sim.run_NVT(
                 n_steps=job.sp.n_steps, kT=job.sp.kT, tau_kt=job.sp.tau_kt
         )
         sim.save_restart_gsd()
+        final_pe = thermo.potential_energy
         print("----------------------")
         print("Simulation finished...")
         print("----------------------")
 
-        if job.doc["swap"]:
-            shutil.copyfile(
-                    job.fn("trajectory.gsd"),
-                    job.fn(f"trajectory_{job.doc.current_run}_swap.gsd")
-            )
-            shutil.copyfile(
-                    job.fn("sim_data.txt"),
-                    job.fn(f"sim_data_{job.doc.current_run}_swap.txt")
-            )
-        else:
-            shutil.copyfile(
-                    job.fn("trajectory.gsd"),
-                    job.fn(f"trajectory_{job.doc.current_run}.gsd")
-            )
-            shutil.copyfile(
-                    job.fn("sim_data.txt"),
-                    job.fn(f"sim_data_{job.doc.current_run}.txt")
+        # Move this run's outputs to their per-run names. The next run writes
+        # new trajectory.gsd and sim_data.txt files, so nothing is copied.
+        suffix = "_swap" if job.doc["swap"] else ""
+        log_file = job.fn(f"sim_data_{job.doc.current_run}{suffix}.txt")
+        os.replace(
+                job.fn("trajectory.gsd"),
+                job.fn(f"trajectory_{job.doc.current_run}{suffix}.gsd")
+        )
+        os.replace(job.fn("sim_data.txt"), log_file)
+
+        pe = read_log_column(log_file)
+        # write the results of this run to the job document at once, the final
+        # potential energy is used by the PT driver to accept or reject swaps
+        with signac.buffered():
+            job.doc["energy"].append(float(final_pe))
+            job.doc["avg_PE"].append(float(np.mean(pe[-N_AVG_PE:])))
+            job.doc["timestep"].append(sim.timestep)
+            job.doc["current_run"] += 1
+        # only flagged done after the results are flushed, the PT driver reads them right away
+        mark_done(job)
+
+
+def check_chain_layout(bonds, n_particles, n_chains):
+    """Make sure the bonds split the particles into n_chains molecules of consecutive, equal length blocks."""
+    if n_particles % n_chains:
+        raise ValueError(
+                f"{n_particles} particles can not be split into {n_chains} chains of equal length"
+        )
+    if bonds is None:
+        raise ValueError("the trajectory has no bonds to check the chains against")
+    length = n_particles // n_chains
+    a, b = bonds[:, 0], bonds[:, 1]
+    if np.any(a // length != b // length):
+        raise ValueError(f"bonds connect particles of different {length} particle blocks")
+    # label every particle with the lowest index it is bonded to until nothing changes
+    labels = np.arange(n_particles)
+    while True:
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, a, labels[b])
+        np.minimum.at(new_labels, b, labels[a])
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+    if np.any(labels.reshape(n_chains, length) != np.arange(0, n_particles, length)[:, None]):
+        raise ValueError(f"the {length} particle blocks are not single bonded molecules")
+    return length
+
+
+def iter_chain_positions(gsd_file, n_chains, start=0, stop=-1):
+    """Yield the unwrapped particle positions of a trajectory frame by frame, grouped by chain.
+    The yielded array is overwritten by the next frame."""
+    import gsd.fl
+
+    with gsd.fl.open(name=gsd_file, mode="rb") as f:
+        def read_chunk(frame, name):
+            # data that does not change is only stored in the first frame
+            if not f.chunk_exists(frame=frame, name=name):
+                frame = 0
+            if not f.chunk_exists(frame=frame, name=name):
+                return None
+            return f.read_chunk(frame=frame, name=name)
+
+        # the chains are consecutive blocks of particles, checked once against the bonds
+        n_particles = len(read_chunk(0, "particles/position"))
+        length = check_chain_layout(read_chunk(0, "bonds/group"), n_particles, n_chains)
+        # unwrapped positions of the current frame, reused for every frame
+        unwrapped = None
+        # only the positions, images and box are decoded, not whole frames
+        for frame in range(f.nframes)[start:stop]:
+            positions = read_chunk(frame, "particles/position")
+            images = read_chunk(frame, "particles/image")
+            box = read_chunk(frame, "configuration/box")
+            if unwrapped is None or unwrapped.shape != positions.shape:
+                unwrapped = np.empty_like(positions)
+            if images is not None:
+                np.multiply(images, box[:3], out=unwrapped, casting="same_kind")
+                unwrapped += positions
+                positions = unwrapped
+            # shaped as a trajectory of a single frame for the Rg and Re kernels
+            yield positions.reshape(1, n_chains, length, 3)
+
+
+def chain_rg_re(chains, head, tail):
+    """Rg and end to end vector of every chain in every frame, written as loops for numba."""
+    n_frames, n_chains, length, _ = chains.shape
+    # results keep the float32 precision of the stored positions
+    rg = np.empty((n_frames, n_chains), dtype=chains.dtype)
+    re_vectors = np.empty((n_frames, n_chains, 3), dtype=chains.dtype)
+    for f in range(n_frames):
+        for c in range(n_chains):
+            center = np.zeros(3, dtype=chains.dtype)
+            for p in range(length):
+                center += chains[f, c, p]
+            center /= length
+            sq_sum = 0.0
+            for p in range(length):
+                for d in range(3):
+                    sq_sum += (chains[f, c, p, d] - center[d]) ** 2
+            rg[f, c] = np.sqrt(sq_sum / length)
+            for d in range(3):
+                re_vectors[f, c, d] = chains[f, c, tail, d] - chains[f, c, head, d]
+    return rg, re_vectors
+
+
+def chain_rg_re_numpy(chains, head, tail):
+    """Rg and end to end vector of every chain in every frame, with NumPy array operations."""
+    rg = np.sqrt(
+            ((chains - chains.mean(axis=2, keepdims=True)) ** 2).sum(axis=3).mean(axis=2)
+    )
+    return rg, chains[:, :, tail] - chains[:, :, head]
+
+
+@functools.lru_cache(maxsize=None)
+def get_rg_re_func():
+    """Compile chain_rg_re with numba, or fall back to NumPy when numba is not installed."""
+    try:
+        from numba import njit
+    except ImportError:
+        return chain_rg_re_numpy
+    # the windows already run in parallel processes, so the kernel itself stays serial
+    return njit(cache=True, fastmath=True)(chain_rg_re)
+
+
+def nematic_order(vectors):
+    """Nematic order parameter of each frame's vectors, the largest eigenvalue of its Q tensor."""
+    u = vectors / np.linalg.norm(vectors, axis=2, keepdims=True)
+    q = 1.5 * np.einsum("fni,fnj->fij", u, u) / u.shape[1] - 0.5 * np.eye(3, dtype=u.dtype)
+    return np.linalg.eigvalsh(q)[:, -1]
+
+
+def analyze_window(gsd_file, log_file, n_chains):
+    """Compute Rg, Re, S2 and the potential energy of one trajectory window."""
+    rg_re = get_rg_re_func()
+    # only one frame of positions is held at a time, the per chain results are small
+    rg_frames = []
+    re_frames = []
+    for chains in iter_chain_positions(gsd_file, n_chains):
+        # the numba kernel does not check bounds, so check the end particles here
+        if max(RE_HEAD, RE_TAIL) >= chains.shape[2]:
+            raise ValueError(
+                    f"chains of {chains.shape[2]} particles have no particles {RE_HEAD} and {RE_TAIL} "
+                    f"to compute end to end vectors between"
             )
-
-        job.doc["timestep"].append(sim.timestep)
-        job.doc["current_run"] += 1
-        job.doc["done"] = True
+        rg, re_vectors = rg_re(chains, RE_HEAD, RE_TAIL)
+        rg_frames.append(rg)
+        re_frames.append(re_vectors)
+    rg_array = np.concatenate(rg_frames)
+    re_vectors = np.concatenate(re_frames)
+    re_array = np.linalg.norm(re_vectors, axis=2)
+    order_params = nematic_order(re_vectors)
+    pe = read_log_column(log_file)
+    # per frame mean and std over the chains, like cmeutils reports them
+    return (
+            rg_array.mean(axis=1), rg_array.std(axis=1), rg_array,
+            re_array.mean(axis=1), re_array.std(axis=1), re_array,
+            order_params, pe
+    )
 
 
 @directives(executable="python -u")
@@ -231,58 +407,62 @@ def sample(job):
 @MyProject.post(averaged)
 @MyProject.pre(pt_done)
 def variables(job):
-    import numpy as np
-    from cmeutils.structure import (
-            radius_of_gyration, end_to_end, nematic_order_param
-    )
+    from concurrent.futures import ProcessPoolExecutor
+
+    n_windows = 101
+    ws = job.ws
+    gsd_files = [os.path.join(ws, f"trajectory_{w + 1}.gsd") for w in range(n_windows)]
+    log_files = [os.path.join(ws, f"sim_data_{w + 1}.txt") for w in range(n_windows)]
+    # the windows are independent, so each one is analyzed in its own process
+    with ProcessPoolExecutor() as executor:
+        results = list(executor.map(
+                analyze_window, gsd_files, log_files,
+                [int(np.sum(job.sp.n_chains))] * n_windows, chunksize=4
+        ))
+
+    def window_buffer(index):
+        # one row per window, shaped like the first window's result at this index
+        first = np.asarray(results[0][index])
+        return np.empty((n_windows,) + first.shape, dtype=first.dtype)
 
     # Rg
-    window_rgs = [] # means
-    window_rg_stds = [] # stds
-    window_rg_arrays = [] # list of vals
+    window_rgs = window_buffer(0) # means
+    window_rg_stds = window_buffer(1) # stds
+    window_rg_arrays = window_buffer(2) # list of vals
     # Re
-    window_res = []
-    window_re_stds = []
-    window_re_arrays = []
+    window_res = window_buffer(3)
+    window_re_stds = window_buffer(4)
+    window_re_arrays = window_buffer(5)
     # S2 Order Param
-    window_order_param = []
+    window_order_param = window_buffer(6)
 
     potential_energy = []
 
-    for i in range(1, 102):
-        gsd_file = job.fn(f"trajectory_{i}.gsd")
-        rg_mean, rg_std, rg_array = radius_of_gyration(
-                gsd_file=str(gsd_file), start=0, stop=-1
-        )
-        window_rgs.append(rg_mean)
-        window_rg_stds.append(rg_std)
-        window_rg_arrays.append(rg_array)
-
-        re_array, re_mean, re_stds, re_vectors = end_to_end(gsd_file, 4, 102, 0, -1)
-        window_res.append(re_mean)
-        window_re_stds.append(re_std)
-        window_re_arrays.append(re_array)
-
-        for vec in re_vectors:
-            op = nematic_order_param(vec, director=(1, 1, 1))
-            window_order_param.append(op.order)
-
-        log_file = job.fn(f"sim_data_{i}.txt")
-        pe = np.genfromtxt(log_file, names=True)[
-                "md.compute.ThermodynamicQuantities.potential_energy"
-        ]
-        potential_energy.extend(pe.tolist())
-
-    np.save(file=job.fn("rg_mean.npy"), arr=np.asarray(window_rgs))
-    np.save(file=job.fn("rg_std.npy"), arr=np.asarray(window_rg_stds))
-    np.save(file=job.fn("rg_array.npy"), arr=np.asarray(window_rg_arrays))
-    np.save(file=job.fn("re_mean.npy"), arr=np.asarray(window_res))
-    np.save(file=job.fn("re_std.npy"), arr=np.asarray(window_re_stds))
-    np.save(file=job.fn("re_array.npy"), arr=np.asarray(window_re_arrays))
-    np.save(file=job.fn("s2_order.npy"), arr=np.asarray(window_order_param))
-    np.save(file=job.fn("potential_energy.npy"), arr=np.asarray(potential_energy))
-
-    job.doc.averaged = False
+    for w, result in enumerate(results):
+        rg_mean, rg_std, rg_array, re_mean, re_std, re_array, order_params, pe = result
+        window_rgs[w] = rg_mean
+        window_rg_stds[w] = rg_std
+        window_rg_arrays[w] = rg_array
+        window_res[w] = re_mean
+        window_re_stds[w] = re_std
+        window_re_arrays[w] = re_array
+        window_order_param[w] = order_params
+        potential_energy.append(pe)
+
+    # one file holding every result, each array is stored under the name of its old .npy file
+    np.savez(
+            job.fn("variables.npz"),
+            rg_mean=window_rgs,
+            rg_std=window_rg_stds,
+            rg_array=window_rg_arrays,
+            re_mean=window_res,
+            re_std=window_re_stds,
+            re_array=window_re_arrays,
+            s2_order=window_order_param.ravel(),
+            potential_energy=np.concatenate(potential_energy),
+    )
+
+    job.doc.averaged = True
 
 if __name__ == "__main__":
     MyProject().main()